@@ -0,0 +1,35 @@
+"""
+Per-call overhead benchmark for CBStorage save/load of a small block.
+
+    python benchmarks/call_overhead.py postgresql://user@host:port/db [n_calls]
+
+Creates (and drops) table 'bench_call_overhead'.
+"""
+import sys
+import time
+
+from st_comp_blocks import CBStorage, ComputationalBlock
+
+
+def run(address, n_calls=500):
+    storage = CBStorage(address, "bench_call_overhead")
+    storage.create_storage().clear_storage()
+    _start = time.perf_counter()
+    for _ in range(n_calls):
+        # new block every time: save(update=False) would grow id_history
+        block = ComputationalBlock(storage).save()
+    _save = (time.perf_counter() - _start) / n_calls
+
+    _start = time.perf_counter()
+    for _ in range(n_calls):
+        ComputationalBlock.load(storage, block.id)
+    _load = (time.perf_counter() - _start) / n_calls
+
+    print("save: %.3f ms/call, load: %.3f ms/call (%d calls)" % (_save * 1000., _load * 1000., n_calls))
+    storage.sql("drop table bench_call_overhead")
+    storage.close()
+    return _save, _load
+
+
+if __name__ == "__main__":
+    run(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 500)
@@ -0,0 +1,37 @@
+"""
+Import-time benchmark for st_comp_blocks.
+
+Runs `import st_comp_blocks` in fresh interpreters and prints the median
+wall time, plus whether pandas/numpy/psycopg2.extras were loaded.
+
+    python benchmarks/import_time.py [n_runs]
+"""
+import sys
+import time
+import statistics
+import subprocess
+
+_CODE = (
+    "import sys, time\n"
+    "_start = time.perf_counter()\n"
+    "import st_comp_blocks\n"
+    "_time = time.perf_counter() - _start\n"
+    "print(_time, *[int(_m in sys.modules) for _m in ('pandas', 'numpy', 'psycopg2.extras')])\n"
+)
+
+
+def run(n_runs=10):
+    times = []
+    loaded = None
+    for _ in range(n_runs):
+        _out = subprocess.check_output([sys.executable, "-c", _CODE]).decode().split()
+        times.append(float(_out[0]))
+        loaded = dict(zip(("pandas", "numpy", "psycopg2.extras"), [bool(int(_v)) for _v in _out[1:]]))
+    print("import st_comp_blocks: median %.1f ms, min %.1f ms (%d runs)" %
+          (statistics.median(times) * 1000., min(times) * 1000., n_runs))
+    print("loaded modules: %s" % loaded)
+    return times
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,59 @@
+"""
+export_snapshot/import_snapshot throughput benchmark.
+
+    python benchmarks/snapshot.py postgresql://user@host:port/db [n_blocks] [bin_size]
+
+Fills table 'bench_snapshot' with n_blocks blocks (each references the previous one
+through a cb_prop, has id_history and bin_size bytes of binary), exports it to a
+temporary file and imports it back. Tables are dropped at the end.
+"""
+import os
+import sys
+import time
+import tempfile
+
+import psycopg2
+
+from st_comp_blocks import CBStorage
+
+
+def run(address, n_blocks=20000, bin_size=16384):
+    storage = CBStorage(address, "bench_snapshot")
+    storage.create_storage().clear_storage()
+
+    # half random, half zeros: bins are partially compressible
+    _json = "json_build_object('__classname__', 'bench.Block', 'id', _i, " \
+            "'id_history', json_build_array(_i - 1), 'hist', json_build_array(1, 2, 3), " \
+            "'prev', json_build_object('__classname__', 'bench.Block', 'id', greatest(_i - 1, 1)))"
+    for _start in range(1, n_blocks + 1, 1000):
+        _stop = min(_start + 1000, n_blocks + 1)
+        _bins = [psycopg2.Binary(os.urandom(bin_size // 2) + bytes(bin_size - bin_size // 2))
+                 for _ in range(_start, _stop)]
+        storage.sql("insert into bench_snapshot (json, bin) "
+                    "select %s::jsonb, (%%(bins)s::bytea[])[_i - %%(start)s + 1] "
+                    "from generate_series(%%(start)s, %%(stop)s - 1) _i" % _json,
+                    dict(bins=_bins, start=_start, stop=_stop))
+    _size = n_blocks * bin_size
+
+    _path = os.path.join(tempfile.mkdtemp(), "bench_snapshot.gz")
+    _start = time.perf_counter()
+    storage.export_snapshot(_path)
+    _export = time.perf_counter() - _start
+
+    _start = time.perf_counter()
+    storage.import_snapshot(_path)
+    _import = time.perf_counter() - _start
+
+    print("%d blocks, %.1f MB of bin, file %.1f MB" %
+          (n_blocks, _size / 2. ** 20, os.path.getsize(_path) / 2. ** 20))
+    print("export: %.2f s (%.1f MB/s), import: %.2f s (%.1f MB/s)" %
+          (_export, _size / 2. ** 20 / _export, _import, _size / 2. ** 20 / _import))
+
+    os.remove(_path)
+    storage.sql("drop table bench_snapshot")
+    storage.close()
+    return _export, _import
+
+
+if __name__ == "__main__":
+    run(sys.argv[1], *[int(_arg) for _arg in sys.argv[2:4]])
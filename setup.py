@@ -39,4 +39,4 @@ setup(name='st_comp_blocks',
           "numpy",
           "psycopg2"
       ],
-      version='0.0.0-dev.1')
+      version='0.0.0-dev.2')
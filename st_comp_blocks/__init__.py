@@ -1,8 +1,15 @@
+import os
+import math
 import time
 import json
+import gzip
+import hashlib
+import shutil
+import tempfile
 import functools
 import warnings
 import importlib
+import collections
 import concurrent.futures
 
 try:
@@ -10,11 +17,7 @@ try:
 except ImportError:
     import urllib.parse as urlparse
 
-import pandas as pd
-
 import psycopg2
-import psycopg2.extras
-import psycopg2.sql
 import psycopg2.extensions
 import psycopg2.errors
 
@@ -40,23 +43,83 @@ def db_connect(address, timeout, on_connect=None):
     return connection, cursor
 
 
+def json_adapter(value, dumps=None):
+    # psycopg2.extras pulls in a lot of modules we don't need, import it on first use
+    import psycopg2.extras
+    return psycopg2.extras.Json(value, dumps=dumps)
+
+
 def db_request(cursor, request, args):
     cursor.execute(request, args)
     return
 
 
+def statement_timeout_ms(timeout):
+    # math.inf timeout - statement_timeout is disabled (0)
+    return 0 if timeout == math.inf else int(timeout * 1000.)
+
+
+def db_copy(cursor, request, file, timeout, size):
+    # copy may take much longer than usual requests, so statement_timeout is set per transaction
+    cursor.execute("set local statement_timeout = %d" % statement_timeout_ms(timeout))
+    cursor.copy_expert(request, file, size=size)
+    return
+
+
+def lsn_to_int(lsn):
+    # 'X/Y' wal position to comparable int
+    _hi, _lo = lsn.split("/")
+    return (int(_hi, 16) << 32) | int(_lo, 16)
+
+
+# errors after which replica is considered unavailable
+_CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
 class SQL(object):
-    def __init__(self, address, timeout=120., connect_timeout=3.0, on_connect=None):
+    """
+    Parameters
+    ==========
+    address: str
+        primary server address
+    replicas: list of str or None
+        read replicas (hot standby) addresses. Requests with read=True are routed
+        to replicas, on failure of all replicas - to primary.
+        on_connect queries are not executed on replicas.
+    balance: 'round_robin' or 'least_latency'
+        replica choice strategy
+    retry_interval: float
+        time in seconds during which failed replica is not used
+    connect: bool
+        connect in constructor or on first request
+    """
+    def __init__(self, address, timeout=120., connect_timeout=3.0, on_connect=None,
+                 replicas=None, balance="round_robin", retry_interval=30., connect=True):
         self.address = address
         self.timeout = timeout
         self.connect_timeout = connect_timeout
 
         self.on_connect_queries = [] if on_connect is None else on_connect
 
+        if balance not in ("round_robin", "least_latency"):
+            raise ValueError("Unrecognized balance value: %s. Should be 'round_robin' or 'least_latency'." % balance)
+        self.balance = balance
+        self.retry_interval = retry_interval
+        self.replicas = [SQL(_address, timeout=timeout, connect_timeout=connect_timeout, connect=False)
+                         for _address in ([] if replicas is None else replicas)]
+        self._rr_pos = -1
+        self._down_until = {}
+
+        # exponential moving average of request time
+        self.latency = None
+        # last seen replayed wal position (for replicas)
+        self.replayed_lsn = None
+
         self.connection = None
         self.cursor = None
 
-        self.connect(connect_timeout)
+        if connect:
+            self.connect(connect_timeout)
 
         self.cur_result = None
         return
@@ -83,17 +146,57 @@ class SQL(object):
             executor.shutdown(wait=False)
         return self
 
-    def __call__(self, request, args=None, timeout=None):
+    def __call__(self, request, args=None, timeout=None, read=False, min_lsn=None):
+        """
+        Parameters
+        ==========
+        read: bool
+            request doesn't modify data and can be executed on replica
+        min_lsn: str or None
+            execute on replica only if it has replayed wal up to min_lsn
+        """
         timeout = self.timeout if timeout is None else timeout
 
-        if self.connection.closed:
+        if read and len(self.replicas) > 0:
+            _res = self._replica_call(request, args, timeout, min_lsn)
+            if _res is not None:
+                return _res
+
+        _start = time.time()
+        self._execute(db_request, (request, args), timeout)
+
+        _descr = self.cursor.description
+        self.cur_result = self.cursor.fetchall() if _descr is not None else None
+
+        _time = time.time() - _start
+        self.latency = _time if self.latency is None else 0.8 * self.latency + 0.2 * _time
+        return self
+
+    def copy(self, request, file, timeout=None, size=1 << 20):
+        """
+        Execute 'copy ... to stdout' or 'copy ... from stdin' request
+            writing to/reading from file object.
+        Copy time depends on data size, so by default (timeout=None) it is not limited.
+        """
+        timeout = math.inf if timeout is None else timeout
+        self._execute(db_copy, (request, file, timeout, size), timeout)
+        self.cur_result = None
+        return self
+
+    def _execute(self, func, args, timeout):
+        if self.connection is None or self.connection.closed:
             self.connect()
 
         executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
         try:
-            _fut = executor.submit(db_request, self.cursor, request, args)
-            _fut.result(timeout=timeout)
+            _fut = executor.submit(func, self.cursor, *args)
+            _fut.result(timeout=None if timeout == math.inf else timeout)
         except (concurrent.futures.TimeoutError, psycopg2.errors.QueryCanceled):
+            # request is still running in executor thread and holds connection
+            try:
+                self.connection.cancel()
+            except psycopg2.Error:
+                pass
             self.connection.rollback()
             raise TimeoutError("Request failed on timeout: %.1f" % timeout)
         except Exception as e:
@@ -103,15 +206,109 @@ class SQL(object):
             executor.shutdown(wait=False)
 
         self.connection.commit()
+        return
 
-        _descr = self.cursor.description
-        self.cur_result = self.cursor.fetchall() if _descr is not None else None
-        return self
+    def _replica_order(self):
+        _now = time.time()
+        _n = len(self.replicas)
+        _alive = [_ind for _ind in range(_n) if self._down_until.get(_ind, 0.) <= _now]
+        if self.balance == "round_robin":
+            self._rr_pos = (self._rr_pos + 1) % _n
+            _alive.sort(key=lambda _ind: (_ind - self._rr_pos) % _n)
+        else:
+            # not measured replicas go first
+            _alive.sort(key=lambda _ind: self.replicas[_ind].latency or 0.)
+        return _alive
+
+    def _replica_failed(self, ind, error):
+        warnings.warn("SQL: replica '%s' unavailable for %.1f s: %s" %
+                      (self.replicas[ind].address, self.retry_interval, str(error)))
+        self._down_until[ind] = time.time() + self.retry_interval
+        try:
+            self.replicas[ind].close()
+        except _CONNECTION_ERRORS:
+            pass
+        return
+
+    def _replica_call(self, request, args, timeout, min_lsn):
+        for _ind in self._replica_order():
+            _replica = self.replicas[_ind]
+            try:
+                if _replica.connection is None or _replica.connection.closed:
+                    _replica.connect()
+            except (TimeoutError,) + _CONNECTION_ERRORS as e:
+                self._replica_failed(_ind, e)
+                continue
+
+            try:
+                if min_lsn is not None and not _replica.wal_replayed(min_lsn, timeout=timeout):
+                    continue
+                return _replica(request, args, timeout=timeout)
+            except psycopg2.extensions.TransactionRollbackError:
+                # hot standby recovery conflict: replica is alive, try next one
+                continue
+            except _CONNECTION_ERRORS as e:
+                # statement timeout (TimeoutError) is not replica failure: heavy request
+                # would be slow everywhere, so it is raised to caller
+                self._replica_failed(_ind, e)
+        return None
+
+    def replayed_lsn_min(self):
+        """
+        Min replayed wal position over available replicas, None if not known for some of them
+        """
+        _now = time.time()
+        _replayed = [_replica.replayed_lsn for _ind, _replica in enumerate(self.replicas)
+                     if self._down_until.get(_ind, 0.) <= _now]
+        if len(_replayed) == 0 or any(_lsn is None for _lsn in _replayed):
+            return None
+        return min(_replayed)
+
+    def wal_lsn(self, timeout=None):
+        """
+        Current wal position of primary server
+        """
+        self("select pg_current_wal_lsn()::text", timeout=timeout)
+        return self.cur_result[0][0]
+
+    def wal_replayed(self, lsn, timeout=None):
+        """
+        Check if replica has replayed wal up to lsn
+        """
+        self("select pg_last_wal_replay_lsn()::text", timeout=timeout)
+        _replayed = self.cur_result[0][0]
+        if _replayed is None:
+            return False
+        self.replayed_lsn = lsn_to_int(_replayed)
+        return self.replayed_lsn >= lsn_to_int(lsn)
+
+    @property
+    def columns(self):
+        if self.cursor.description is None:
+            return None
+        return [_el[0] for _el in self.cursor.description]
+
+    def to_tuples(self):
+        """
+        Raw result rows as returned by the cursor (list of tuples)
+        """
+        return self.cur_result
+
+    def to_dicts(self):
+        """
+        Result rows as list of dicts {column_name: value}
+        """
+        _keys = self.columns
+        if _keys is None:
+            return None
+        return [dict(zip(_keys, _row)) for _row in self.cur_result]
 
     def to_pandas(self):
         if self.cursor.description is None:
             return None
 
+        import pandas as pd
+
         _keys = [_el[0] for _el in self.cursor.description]
         if len(_keys) > 0:
             _rows = [_row for _row in self.cur_result]
@@ -139,10 +336,45 @@ class SQL(object):
         return self("SELECT * FROM pg_stat_activity")
         
     def close(self):
-        self.connection.close()
+        if self.connection is not None:
+            self.connection.close()
+        for _replica in self.replicas:
+            _replica.close()
         return self
 
 
+class _ProgressFile(object):
+    """
+    File wrapper, calls progress(n_bytes) after every read/write
+    """
+    def __init__(self, file, progress=None):
+        self.file = file
+        self.progress = progress
+        self.n_bytes = 0
+        return
+
+    def _step(self, size):
+        self.n_bytes += size
+        if self.progress is not None:
+            self.progress(self.n_bytes)
+        return
+
+    def read(self, size=-1):
+        _data = self.file.read(size)
+        self._step(len(_data))
+        return _data
+
+    def readline(self, size=-1):
+        _data = self.file.readline(size)
+        self._step(len(_data))
+        return _data
+
+    def write(self, data):
+        self.file.write(data)
+        self._step(len(data))
+        return len(data)
+
+
 class CBStorage(object):
     """
     Computational Block Storage
@@ -158,15 +390,52 @@ class CBStorage(object):
     );
     """
     
+    # max number of blocks tracked for read_your_writes
+    read_your_writes_size = 10000
+    # read_date of blocks loaded from replicas is updated on primary in batches
+    touch_batch = 100
+    touch_interval = 60.
+
     def __init__(self, db_path, table_name, timeout=120.0, connect_timeout=4.0,
-                 mode="rw", dumps=None):
+                 mode="rw", dumps=None, replicas=None, balance="round_robin",
+                 replica_reads=None, read_your_writes=False, archive_dir=None):
+        """
+        Parameters
+        ==========
+        db_path: str
+            primary server address, all writes go here
+        replicas: list of str or None
+            read replicas addresses
+        balance: 'round_robin' or 'least_latency'
+        replica_reads: bool or None
+            route reads (select, load, pull_patch_props) to replicas.
+            None means True for mode='ro' and False for mode='rw'
+        read_your_writes: bool
+            block saved (or patched) by this storage is read only from
+            replicas which have already replayed this write
+            (for last read_your_writes_size written blocks)
+        archive_dir: str or None
+            directory for blocks archived with archive_cold(target='file'),
+            should be accessible from all storage users
+        """
         self.db_path = db_path
         self.table_name = table_name
         self.mode = mode
         self.dumps = functools.partial(json.dumps, cls=CustomJsonEncoder) if dumps is None else dumps
-        
+
+        self.replica_reads = (mode == "ro") if replica_reads is None else replica_reads
+        self.read_your_writes = read_your_writes
+        self.archive_dir = archive_dir
+        # table has archive column, checked on first use
+        self._has_archive = None
+        # block_id -> primary wal position after last write of the block (in write order)
+        self._write_lsn = collections.OrderedDict()
+        # blocks loaded from replicas, read_date is not updated yet
+        self._touch_ids = set()
+        self._touch_time = time.time()
+
         self.sql = SQL(db_path, timeout=timeout, connect_timeout=connect_timeout,
-                       on_connect=self._get_on_connect())
+                       on_connect=self._get_on_connect(), replicas=replicas, balance=balance)
         return
 
     def _get_on_connect(self):
@@ -185,9 +454,64 @@ class CBStorage(object):
             raise ValueError("Unrecognized mode value: %s. Sould be 'rw' or 'ro'." % self.mode)
 
     def close(self):
+        self.flush_reads()
         self.sql.close()
         return self
 
+    def _use_replicas(self):
+        return self.replica_reads and len(self.sql.replicas) > 0
+
+    def _read(self, request, args=None, block_id=None, timeout=None):
+        _lsn = self._write_lsn.get(block_id)
+        _res = self.sql(request, args, timeout=timeout, read=self.replica_reads, min_lsn=_lsn)
+        if _lsn is not None:
+            self._prune_write_lsn()
+        return _res
+
+    def _wrote(self, block_ids, timeout=None):
+        if self.read_your_writes and len(self.sql.replicas) > 0:
+            _lsn = self.sql.wal_lsn(timeout=timeout)
+            for _id in block_ids:
+                self._write_lsn.pop(int(_id), None)
+                self._write_lsn[int(_id)] = _lsn
+            while len(self._write_lsn) > self.read_your_writes_size:
+                self._write_lsn.popitem(last=False)
+        return
+
+    def _prune_write_lsn(self):
+        # writes replayed by all available replicas don't need tracking
+        _replayed = self.sql.replayed_lsn_min()
+        if _replayed is None:
+            return
+        while len(self._write_lsn) > 0 and lsn_to_int(next(iter(self._write_lsn.values()))) <= _replayed:
+            self._write_lsn.popitem(last=False)
+        return
+
+    def _touch(self, block_id, timeout=None):
+        self._touch_ids.add(int(block_id))
+        if len(self._touch_ids) >= self.touch_batch or \
+                time.time() - self._touch_time >= self.touch_interval:
+            self.flush_reads(timeout=timeout)
+        return
+
+    def flush_reads(self, timeout=None):
+        """
+        Update read_date on primary for blocks loaded from replicas.
+            Done in batches (touch_batch, touch_interval) and not more often than once an hour
+            per block: read_date is used only for cold blocks tiering (archive_cold).
+        """
+        _ids, self._touch_ids = self._touch_ids, set()
+        self._touch_time = time.time()
+        if len(_ids) == 0:
+            return self
+        try:
+            self.sql("update %s set read_date=current_timestamp where id in (%s) "
+                     "and read_date < current_timestamp - interval '1 hour';" %
+                     (self.table_name, ", ".join([str(_id) for _id in sorted(_ids)])), timeout=timeout)
+        except (TimeoutError, psycopg2.Error) as e:
+            warnings.warn("CBStorage: read_date update failed: %s" % str(e))
+        return self
+
     ################################################
     # Storage visualizations
     ################################################
@@ -200,14 +524,18 @@ class CBStorage(object):
         if order_by is not None:
             _request += " order by %s" % order_by
 
-        return self.sql(_request, timeout=timeout)
+        return self._read(_request, timeout=timeout)
 
     def show(self, timeout=None):
         return self.select("*", timeout=timeout)
 
-    def show_class(self, cls, what="*", where=None, order_by=None, timeout=None):
+    @staticmethod
+    def _class_where(cls):
         _class_name = "%s.%s" % (cls.__module__, cls.__name__)
-        _where = "json->>'__classname__' = '%s'" % _class_name
+        return "json->>'__classname__' = '%s'" % _class_name
+
+    def show_class(self, cls, what="*", where=None, order_by=None, timeout=None):
+        _where = self._class_where(cls)
         where = "%s and %s" % (where, _where) if where else _where
         return self.select(what, where, order_by, timeout=timeout)
 
@@ -216,13 +544,28 @@ class CBStorage(object):
     ################################################
 
     def _load(self, what, block_id, timeout=None):
-        query = "update %%(table_name)s set read_date=current_timestamp where id=%%(id_value)s;" \
-                "select %s from %%(table_name)s where id=%%(id_value)s;" % what
-        _res = self.sql(query, dict(table_name=psycopg2.extensions.AsIs(self.table_name), id_value=block_id),
-                        timeout=timeout)
+        if what == "bin":
+            # archive state is needed to restore archived block,
+            # to_jsonb: works for tables created without archive column
+            what = "bin, case when bin is null then to_jsonb(t)->>'archive' end as archive"
+        _touch = "update %(table_name)s set read_date=current_timestamp where id=%(id_value)s;"
+        _select = "select %s from %%(table_name)s t where id=%%(id_value)s;" % what
+        _args = dict(table_name=psycopg2.extensions.AsIs(self.table_name), id_value=block_id)
+        if self._use_replicas():
+            # replicas are read-only: read_date is updated on primary
+            self._touch(block_id, timeout=timeout)
+            _res = self._read(_select, _args, block_id=block_id, timeout=timeout)
+        else:
+            _res = self.sql(_touch + _select, _args, timeout=timeout)
         if _res.rowcount == 0:
             raise ValueError("No such block_id: %s" % str(block_id))
 
+        _row = _res.to_dicts()[0]
+        if _row.get("bin", b"") is None and _row.get("archive") is not None and \
+                self._restore(block_id, _row["archive"], timeout=timeout):
+            # replicas may not have restored block yet
+            _res = self.sql(_select, _args, timeout=timeout)
+
         return _res
 
     def load_json(self, block_id, timeout=None):
@@ -246,7 +589,7 @@ class CBStorage(object):
             if _ind < len(patch_names)-1:
                 _query += ", "
         _query += " from %s where id=%d;" % (self.table_name, block_id)
-        _res = self.sql(_query, timeout=timeout)
+        _res = self._read(_query, block_id=block_id, timeout=timeout)
         if _res.rowcount == 0:
             raise ValueError("No such block_id: %s" % str(block_id))
         return _res
@@ -269,9 +612,10 @@ class CBStorage(object):
             _query += "update %s set "\
                       "json=jsonb_set(json, '{%s}', json->'%s' || %%(%s)s)"\
                       "where id=%d;\n" % (self.table_name, _pn, _pn, _pn, block_id)
-        _res = self.sql(_query, {_pn: psycopg2.extras.Json(_val, dumps=self.dumps)
+        _res = self.sql(_query, {_pn: json_adapter(_val, dumps=self.dumps)
                                  for _pn, _val in patches.items()},
                         timeout=timeout)
+        self._wrote([block_id], timeout=timeout)
         return
 
     def save_json(self, block_json, block_id=None, timeout=None):
@@ -281,19 +625,25 @@ class CBStorage(object):
         block_json: object
             object we can dump to json format
         block_id: int or None
+
+        Returns
+        =======
+        list with id of saved block (numpy array before 0.0.0-dev.2)
         """
         if block_id is None:
             query = "insert into %s (json)" \
                     " values (%%(json_value)s) returning id;" % self.table_name
-            ids = self.sql(query, dict(json_value=psycopg2.extras.Json(block_json, dumps=self.dumps)),
-                           timeout=timeout).to_pandas()
-            return ids['id'].values
+            ids = self.sql(query, dict(json_value=json_adapter(block_json, dumps=self.dumps)),
+                           timeout=timeout).to_tuples()
+            ids = [_row[0] for _row in ids]
         else:
             query = "update %s set json=%%(json_value)s, "\
                     "update_date=current_timestamp where id=%%(block_id)s;" % self.table_name
-            self.sql(query, dict(json_value=psycopg2.extras.Json(block_json, dumps=self.dumps),
-                                 timeout=timeout, block_id=block_id))
-            return [block_id]
+            self.sql(query, dict(json_value=json_adapter(block_json, dumps=self.dumps),
+                                 block_id=block_id), timeout=timeout)
+            ids = [block_id]
+        self._wrote(ids, timeout=timeout)
+        return ids
 
     def save_binary(self, block_binary, block_id=None, timeout=None):
         """
@@ -302,19 +652,46 @@ class CBStorage(object):
         block_binary: binary str
             binary data converted to string
         block_id: int or None
+
+        Returns
+        =======
+        list with id of saved block (numpy array before 0.0.0-dev.2)
         """
         if block_id is None:
             query = "insert into %s (bin)" \
                     " values (%%(bin_value)s) returning id;" % self.table_name
             ids = self.sql(query, dict(bin_value=psycopg2.Binary(block_binary)),
-                           timeout=timeout).to_pandas()
-            return ids['id'].values
+                           timeout=timeout).to_tuples()
+            ids = [_row[0] for _row in ids]
         else:
-            query = "update %s set bin=%%(bin_value)s, "\
-                    "update_date=current_timestamp where id=%%(block_id)s;" % self.table_name
-            self.sql(query, dict(bin_value=psycopg2.Binary(block_binary),
-                                 timeout=timeout, block_id=block_id))
-            return [block_id]
+            self._update_bin("bin=%(bin_value)s",
+                             dict(bin_value=psycopg2.Binary(block_binary), block_id=block_id),
+                             timeout=timeout)
+            ids = [block_id]
+        self._wrote(ids, timeout=timeout)
+        return ids
+
+    def _update_bin(self, values, args, timeout=None):
+        """
+        Update bin (and other values) of block args['block_id'].
+            Archived copy of the block becomes stale and is removed.
+        """
+        if not self._archive_column(timeout=timeout):
+            self.sql("update %s set %s, update_date=current_timestamp where id=%%(block_id)s;" %
+                     (self.table_name, values), args, timeout=timeout)
+            return
+
+        _res = self.sql("with _old as (select archive from %s where id=%%(block_id)s) "
+                        "update %s set %s, archive=null, update_date=current_timestamp "
+                        "where id=%%(block_id)s returning (select archive from _old);" %
+                        (self.table_name, self.table_name, values), args, timeout=timeout).to_tuples()
+        _archive = _res[0][0] if len(_res) > 0 else None
+        if _archive == "table":
+            self.sql("delete from %s_cold where id=%%(block_id)s;" % self.table_name, args, timeout=timeout)
+        elif _archive == "file" and self.archive_dir is not None and \
+                os.path.exists(self._archive_path(args["block_id"])):
+            os.remove(self._archive_path(args["block_id"]))
+        return
 
     def save(self, block_json, block_binary, block_id=None, timeout=None):
         """
@@ -326,6 +703,10 @@ class CBStorage(object):
             binary data converted to string
         block_id: int or None
 
+        Returns
+        =======
+        list with id of saved block (numpy array before 0.0.0-dev.2)
+
         Notes
         =====
         make available lists in json and binary
@@ -333,47 +714,503 @@ class CBStorage(object):
         if block_id is None:
             query = "insert into %s (json, bin)" \
                     " values (%%(json_value)s, %%(bin_value)s) returning id;" % self.table_name
-            ids = self.sql(query, dict(json_value=psycopg2.extras.Json(block_json, dumps=self.dumps),
+            ids = self.sql(query, dict(json_value=json_adapter(block_json, dumps=self.dumps),
                                        bin_value=psycopg2.Binary(block_binary)),
-                           timeout=timeout).to_pandas()
-            return ids['id'].values
+                           timeout=timeout).to_tuples()
+            ids = [_row[0] for _row in ids]
         else:
-            query = "update %s set json=%%(json_value)s, bin=%%(bin_value)s, "\
-                    "update_date=current_timestamp where id=%%(block_id)s;" % self.table_name
-            self.sql(query, dict(json_value=psycopg2.extras.Json(block_json, dumps=self.dumps),
-                                 bin_value=psycopg2.Binary(block_binary),
-                                 block_id=block_id), timeout=timeout)
-            return [block_id]
+            self._update_bin("json=%(json_value)s, bin=%(bin_value)s",
+                             dict(json_value=json_adapter(block_json, dumps=self.dumps),
+                                  bin_value=psycopg2.Binary(block_binary),
+                                  block_id=block_id), timeout=timeout)
+            ids = [block_id]
+        self._wrote(ids, timeout=timeout)
+        return ids
 
     ################################################
     # Storage manipulations
     ################################################
 
-    def create_storage(self, timeout=None):
-        self.sql("""
-        create table if not exists %s (
-        id bigserial not null primary key,
-        json jsonb,
-        bin bytea,
-        create_date timestamp default current_timestamp,
-        update_date timestamp default current_timestamp,
-        read_date timestamp default current_timestamp        
-        );
-        """ % self.table_name, timeout=timeout)
+    def create_storage(self, timeout=None, partition_by=None):
+        """
+        Parameters
+        ==========
+        partition_by: None, 'class' or 'time'
+            create partitioned table: list partitions by block class name
+            or range partitions by create_date. Only default partition is created,
+            others are added with create_partition.
+        """
+        if partition_by is None:
+            self.sql("""
+            create table if not exists %s (
+            id bigserial not null primary key,
+            json jsonb,
+            bin bytea,
+            create_date timestamp default current_timestamp,
+            update_date timestamp default current_timestamp,
+            read_date timestamp default current_timestamp,
+            archive text
+            );
+            """ % self.table_name, timeout=timeout)
+            self._has_archive = None
+            self._add_archive_column(timeout=timeout)
+        elif partition_by in ("class", "time"):
+            # primary key can't contain expressions, so class partitioned table has only index on id
+            _key, _partition = {
+                "class": ("", "list ((json->>'__classname__'))"),
+                "time": (",\n            primary key (id, create_date)", "range (create_date)")
+            }[partition_by]
+            self.sql("""
+            create table if not exists %s (
+            id bigserial not null,
+            json jsonb,
+            bin bytea,
+            create_date timestamp default current_timestamp,
+            update_date timestamp default current_timestamp,
+            read_date timestamp default current_timestamp,
+            archive text%s
+            ) partition by %s;
+            create index if not exists %s_id_idx on %s (id);
+            create table if not exists %s_default partition of %s default;
+            """ % (self.table_name, _key, _partition, self.table_name, self.table_name,
+                   self.table_name, self.table_name), timeout=timeout)
+            self._has_archive = None
+        else:
+            raise ValueError("Unrecognized partition_by value: %s. Should be None, 'class' or 'time'." % partition_by)
+        return self
+
+    def create_partition(self, cls=None, date_range=None, timeout=None):
+        """
+        Add partition to storage created with partition_by='class' (cls)
+            or partition_by='time' (date_range).
+        Should be done before blocks of the partition are saved to default partition.
+
+        Parameters
+        ==========
+        cls: ComputationalBlock subclass or None
+        date_range: (datetime, datetime) or None
+            create_date range [start, stop)
+        """
+        if (cls is None) == (date_range is None):
+            raise ValueError("Exactly one of cls and date_range should be specified")
+
+        if cls is not None:
+            _class_name = "%s.%s" % (cls.__module__, cls.__name__)
+            # hash: classes with the same name from different modules
+            _name = "%s_%s_%s" % (self.table_name, hashlib.md5(_class_name.encode()).hexdigest()[:8],
+                                  cls.__name__.lower())
+            query = "create table if not exists %s partition of %s for values in (%%(value)s);" % \
+                    (_name, self.table_name)
+            args = dict(value=_class_name)
+        else:
+            _name = "%s_%s" % (self.table_name, date_range[0].strftime("%Y%m%d%H%M%S"))
+            query = "create table if not exists %s partition of %s for values from (%%(start)s) to (%%(stop)s);" % \
+                    (_name, self.table_name)
+            args = dict(start=date_range[0], stop=date_range[1])
+        self.sql(query, args, timeout=timeout)
         return self
     
     def clear_storage(self, timeout=None):
         self.sql("delete from %s where id>-1; "
-                 "alter sequence %s_id_seq restart with 1;" %
-                 (self.table_name, self.table_name), timeout=timeout)
+                 "alter sequence %s_id_seq restart with 1;"
+                 "drop table if exists %s_cold;" %
+                 (self.table_name, self.table_name, self.table_name), timeout=timeout)
+        self._write_lsn.clear()
+        if self.archive_dir is not None:
+            shutil.rmtree(self._archive_path(), ignore_errors=True)
         return self
 
     def delete_ids(self, id_list, timeout=None):
-        id_list = ", ".join([str(_id) for _id in id_list])
-        self.sql("delete from %s where id in (%s);" % (self.table_name, id_list),
+        id_list = list(id_list)
+        _id_list = ", ".join([str(_id) for _id in id_list])
+        self.sql("delete from %s where id in (%s);"
+                 "do $$ begin if to_regclass('%s_cold') is not null then "
+                 "delete from %s_cold where id in (%s); end if; end $$;" %
+                 (self.table_name, _id_list, self.table_name, self.table_name, _id_list),
                  timeout=timeout)
+        for _id in id_list:
+            self._write_lsn.pop(int(_id), None)
+            if self.archive_dir is not None and os.path.exists(self._archive_path(_id)):
+                os.remove(self._archive_path(_id))
+        return self
+
+    ################################################
+    # Cold blocks tiering
+    ################################################
+
+    def _archive_column(self, timeout=None):
+        # tables created before tiering have no archive column
+        if self._has_archive is None:
+            self._has_archive = self.sql(
+                "select exists(select 1 from pg_attribute where attrelid = to_regclass('%s') "
+                "and attname = 'archive' and not attisdropped);" % self.table_name,
+                timeout=timeout).to_tuples()[0][0]
+        return self._has_archive
+
+    def _add_archive_column(self, timeout=None):
+        # alter table takes access exclusive lock even if column exists, so check first
+        if not self._archive_column(timeout=timeout):
+            self.sql("alter table %s add column if not exists archive text;" % self.table_name,
+                     timeout=timeout)
+            self._has_archive = True
+        return
+
+    def _archive_path(self, block_id=None):
+        if self.archive_dir is None:
+            raise ValueError("archive_dir is not set")
+        _path = os.path.join(self.archive_dir, self.table_name)
+        if block_id is None:
+            return _path
+        return os.path.join(_path, "%d.bin.gz" % int(block_id))
+
+    def archive_cold(self, days, target="table", limit=None, timeout=None):
+        """
+        Move binaries of blocks not read (and not updated) for days to cold storage.
+            Hot table keeps block json, bin is set to null, archive column
+            stores target. Archived blocks are restored on load.
+
+        Parameters
+        ==========
+        days: float
+        target: 'table' or 'file'
+            '<table_name>_cold' table or files in archive_dir
+        limit: int or None
+            max number of blocks to archive
+
+        Returns
+        =======
+        list of archived ids
+        """
+        _cold = "bin is not null and " \
+                "greatest(read_date, update_date) < current_timestamp - %(days)s * interval '1 day'"
+        _limit = "" if limit is None else " limit %d" % int(limit)
+        _args = dict(days=days)
+
+        self._add_archive_column(timeout=timeout)
+
+        if target == "table":
+            query = "create table if not exists %s_cold (" \
+                    "id bigint not null primary key, bin bytea, " \
+                    "archive_date timestamp default current_timestamp);" % self.table_name
+            query += "with _cold as (" \
+                     "select id from %s where %s order by id%s for update skip locked" \
+                     "), _moved as (" \
+                     "insert into %s_cold (id, bin) select t.id, t.bin from %s t join _cold c on t.id = c.id " \
+                     "on conflict (id) do update set bin = excluded.bin, archive_date = current_timestamp " \
+                     "returning id" \
+                     ") update %s set bin = null, archive = 'table' where id in (select id from _moved) " \
+                     "returning id;" % (self.table_name, _cold, _limit, self.table_name, self.table_name,
+                                        self.table_name)
+            return [_row[0] for _row in self.sql(query, _args, timeout=timeout).to_tuples()]
+        elif target == "file":
+            os.makedirs(self._archive_path(), exist_ok=True)
+            _blocks = self.sql("select id from %s where %s order by id%s;" % (self.table_name, _cold, _limit),
+                               _args, timeout=timeout).to_tuples()
+            ids = []
+            for _id, in _blocks:
+                # session lock: block is not archived by other archive_cold runs
+                _lock = "hashtextextended('%s:' || %%(id)s::text, 0)" % self.table_name
+                if not self.sql("select pg_try_advisory_lock(%s);" % _lock, dict(id=_id),
+                                timeout=timeout).to_tuples()[0][0]:
+                    continue
+                try:
+                    if self._archive_file(_id, timeout=timeout):
+                        ids.append(_id)
+                finally:
+                    self.sql("select pg_advisory_unlock(%s);" % _lock, dict(id=_id), timeout=timeout)
+            return ids
+        else:
+            raise ValueError("Unrecognized target value: %s. Should be 'table' or 'file'." % target)
+
+    def _archive_file(self, block_id, timeout=None):
+        _res = self.sql("select bin, update_date from %s where id=%%(id)s and bin is not null;" %
+                        self.table_name, dict(id=block_id), timeout=timeout).to_tuples()
+        if len(_res) == 0:
+            return False
+        _bin, _update_date = _res[0]
+
+        # file should be on disk before bin is removed from table
+        _path = self._archive_path(block_id)
+        _dir = os.path.dirname(_path)
+        _fd, _tmp_path = tempfile.mkstemp(dir=_dir, suffix=".tmp")
+        try:
+            with os.fdopen(_fd, "wb") as _raw:
+                with gzip.GzipFile(fileobj=_raw, mode="wb", compresslevel=1) as _file:
+                    _file.write(_bin)
+                _raw.flush()
+                os.fsync(_raw.fileno())
+            os.replace(_tmp_path, _path)
+        except BaseException:
+            if os.path.exists(_tmp_path):
+                os.remove(_tmp_path)
+            raise
+        _dir_fd = os.open(_dir, os.O_RDONLY)
+        try:
+            os.fsync(_dir_fd)
+        finally:
+            os.close(_dir_fd)
+
+        # block could be saved while we were writing file
+        _res = self.sql("update %s set bin = null, archive = 'file' "
+                        "where id=%%(id)s and update_date=%%(update_date)s and bin is not null returning id;" %
+                        self.table_name, dict(id=block_id, update_date=_update_date),
+                        timeout=timeout).to_tuples()
+        if len(_res) == 0:
+            os.remove(_path)
+            return False
+        return True
+
+    def _restore(self, block_id, archive, timeout=None):
+        """
+        Restore archived block binary to hot table. Returns False if block is not archived.
+        """
+        if archive == "table":
+            _res = self.sql("with _restored as ("
+                            "update %s t set bin = c.bin, archive = null from %s_cold c "
+                            "where t.id = c.id and t.id=%%(id)s and t.archive = 'table' returning t.id"
+                            ") delete from %s_cold where id in (select id from _restored) returning id;" %
+                            (self.table_name, self.table_name, self.table_name),
+                            dict(id=block_id), timeout=timeout).to_tuples()
+            if len(_res) == 0:
+                # block could be restored by other storage user
+                _res = self.sql("select archive from %s where id=%%(id)s;" % self.table_name,
+                                dict(id=block_id), timeout=timeout).to_tuples()
+                if len(_res) > 0 and _res[0][0] is None:
+                    return True
+                raise ValueError("Archived block %s is not found in %s_cold" % (str(block_id), self.table_name))
+        elif archive == "file":
+            _path = self._archive_path(block_id)
+            try:
+                with gzip.open(_path, "rb") as _file:
+                    _bin = _file.read()
+            except FileNotFoundError:
+                # block could be restored by other storage user
+                _res = self.sql("select archive from %s where id=%%(id)s;" % self.table_name,
+                                dict(id=block_id), timeout=timeout).to_tuples()
+                if len(_res) > 0 and _res[0][0] is None:
+                    return True
+                raise
+            _res = self.sql("update %s set bin = %%(bin)s, archive = null "
+                            "where id=%%(id)s and archive = 'file' returning id;" % self.table_name,
+                            dict(bin=psycopg2.Binary(_bin), id=block_id), timeout=timeout).to_tuples()
+            if len(_res) > 0:
+                os.remove(_path)
+        else:
+            return False
+
+        self._wrote([block_id], timeout=timeout)
+        return True
+
+    ################################################
+    # Snapshots
+    ################################################
+
+    # %s - bin column expression
+    _snapshot_columns = "t.id::bigint, t.json, %s, t.create_date, t.update_date, t.read_date"
+
+    # replace ids of block json (own id, id_history) and its cb_props (recursively)
+    # with new ids from _cb_snapshot_map. id_history ids which are not in snapshot
+    # are set to null, other ids which are not in snapshot are kept
+    _remap_function = """
+    create or replace function pg_temp.cb_remap_ids(j jsonb) returns jsonb as $$
+    declare
+        _res jsonb := j;
+        _key text;
+        _value jsonb;
+    begin
+        if jsonb_typeof(j) is distinct from 'object' or not j ? '__classname__' then
+            return j;
+        end if;
+
+        if jsonb_typeof(j->'id') = 'number' then
+            _res := jsonb_set(_res, '{id}', coalesce(
+                (select to_jsonb(m.new_id) from pg_temp._cb_snapshot_map m where m.old_id = (j->>'id')::bigint),
+                j->'id'));
+        end if;
+        if jsonb_typeof(j->'id_history') = 'array' then
+            _res := jsonb_set(_res, '{id_history}', (
+                select coalesce(jsonb_agg(coalesce(
+                    (select to_jsonb(m.new_id) from pg_temp._cb_snapshot_map m where m.old_id =
+                        case when jsonb_typeof(_el) = 'number' then (_el#>>'{}')::bigint end),
+                    'null'::jsonb) order by _ord), '[]'::jsonb)
+                from jsonb_array_elements(j->'id_history') with ordinality as _t(_el, _ord)));
+        end if;
+
+        -- cb_props: json of other blocks
+        for _key, _value in select e.key, e.value from jsonb_each(j) e
+                            where jsonb_typeof(e.value) = 'object' and e.value ? '__classname__' loop
+            _res := jsonb_set(_res, array[_key], pg_temp.cb_remap_ids(_value));
+        end loop;
+        return _res;
+    end; $$ language plpgsql;
+    """
+
+    # ids of blocks referenced (through cb_props) by blocks of _cb_snapshot, but not in snapshot
+    _unresolved_query = """
+    with recursive _refs(j) as (
+        select e.value from pg_temp._cb_snapshot s,
+            jsonb_each(case when jsonb_typeof(s.json) = 'object' then s.json else '{}'::jsonb end) e
+        where jsonb_typeof(e.value) = 'object' and e.value ? '__classname__'
+        union all
+        select e.value from _refs r, jsonb_each(r.j) e
+        where jsonb_typeof(e.value) = 'object' and e.value ? '__classname__'
+    )
+    select distinct (j->>'id')::bigint from _refs
+    where jsonb_typeof(j->'id') = 'number' and not exists (
+        select 1 from pg_temp._cb_snapshot_map m where m.old_id = (j->>'id')::bigint)
+    order by 1;
+    """
+
+    def _snapshot_where(self, where=None, cls=None, id_range=None):
+        _where = [] if where is None else ["(%s)" % where]
+        if cls is not None:
+            _where.append(self._class_where(cls))
+        if id_range is not None:
+            _where.append("id >= %d and id < %d" % (int(id_range[0]), int(id_range[1])))
+        return " and ".join(_where) if len(_where) > 0 else None
+
+    def export_snapshot(self, path, where=None, cls=None, id_range=None, with_refs=True,
+                        compresslevel=1, progress=None, timeout=None):
+        """
+        Save table (or its part) to local file using binary copy
+
+        Parameters
+        ==========
+        path: str
+            snapshot file path
+        where: str or None
+            sql condition on exported rows
+        cls: ComputationalBlock subclass or None
+            export only blocks of this class
+        id_range: (int, int) or None
+            export only blocks with id_range[0] <= id < id_range[1]
+        with_refs: bool
+            also export blocks referenced (recursively) through cb_props by selected blocks
+        compresslevel: int
+            gzip compression level, 0 - no compression.
+            gzip (even level 1) is much slower than disk, use 0 for fastest export
+        progress: callable or None
+            progress(n_bytes) is called with number of (uncompressed) bytes written
+        timeout: float or None
+            None - no time limit
+
+        Notes
+        =====
+        Binaries of blocks archived to '<table_name>_cold' table (see archive_cold) are exported,
+        blocks archived to files should be restored (loaded) before export.
+        """
+        timeout = math.inf if timeout is None else timeout
+
+        _where = self._snapshot_where(where, cls, id_range)
+        if _where is None:
+            _ids = None
+        elif not with_refs:
+            _ids = "select id from %s where %s" % (self.table_name, _where)
+        else:
+            _ids = "with recursive _ids(id) as (" \
+                   "select id from %s where %s " \
+                   "union " \
+                   "select (e.value->>'id')::bigint from %s t join _ids i on t.id = i.id, " \
+                   "jsonb_each(case when jsonb_typeof(t.json) = 'object' then t.json else '{}'::jsonb end) e " \
+                   "where jsonb_typeof(e.value) = 'object' and e.value ? '__classname__' " \
+                   "and jsonb_typeof(e.value->'id') = 'number'" \
+                   ") select id from _ids" % (self.table_name, _where, self.table_name)
+        _filter = "" if _ids is None else " and t.id in (%s)" % _ids
+
+        _has_archive, _has_cold = self.sql(
+            "select exists(select 1 from pg_attribute where attrelid = '%s'::regclass "
+            "and attname = 'archive' and not attisdropped), to_regclass('%s_cold') is not null;" %
+            (self.table_name, self.table_name), timeout=timeout).to_tuples()[0]
+        if _has_archive:
+            _n_files = self.sql("select count(*) from %s t where t.bin is null and t.archive = 'file'%s;" %
+                                (self.table_name, _filter), timeout=timeout).to_tuples()[0][0]
+            if _n_files > 0:
+                raise ValueError("%d exported blocks are archived to files, load them before export" % _n_files)
+
+        if _has_cold:
+            _query = "select %s from %s t left join %s_cold c on c.id = t.id and t.bin is null " \
+                     "where true%s" % (self._snapshot_columns % "coalesce(t.bin, c.bin)",
+                                       self.table_name, self.table_name, _filter)
+        else:
+            _query = "select %s from %s t where true%s" % (self._snapshot_columns % "t.bin",
+                                                           self.table_name, _filter)
+        _query = "copy (%s) to stdout with (format binary)" % _query
+
+        _file = gzip.open(path, "wb", compresslevel=compresslevel) if compresslevel > 0 else open(path, "wb")
+        with _file:
+            self.sql.copy(_query, _ProgressFile(_file, progress), timeout=timeout)
         return self
 
+    def import_snapshot(self, path, unresolved="raise", progress=None, timeout=None):
+        """
+        Load blocks from snapshot file (created with export_snapshot) to storage.
+        Blocks get new ids, ids inside blocks json (id, id_history, cb_props)
+            are replaced with new ones if referenced block is in snapshot.
+            Previous versions (id_history) are not exported with block,
+            their ids which are not in snapshot are set to null.
+
+        Parameters
+        ==========
+        path: str
+            snapshot file path
+        unresolved: 'raise', 'warn' or 'ignore'
+            what to do if blocks reference (through cb_props) blocks which are not
+            in snapshot. Such references keep old ids.
+        progress: callable or None
+            progress(n_bytes) is called with number of (uncompressed) bytes read
+        timeout: float or None
+            None - no time limit
+
+        Returns
+        =======
+        dict {old_id: new_id}
+        """
+        if unresolved not in ("raise", "warn", "ignore"):
+            raise ValueError("Unrecognized unresolved value: %s. Should be 'raise', 'warn' or 'ignore'." %
+                             unresolved)
+        timeout = math.inf if timeout is None else timeout
+        _set_timeout = "set local statement_timeout = %d;" % statement_timeout_ms(timeout)
+
+        with open(path, "rb") as _file:
+            _gzip = _file.read(2) == b"\x1f\x8b"
+        _file = gzip.open(path, "rb") if _gzip else open(path, "rb")
+
+        self.sql("drop table if exists pg_temp._cb_snapshot;"
+                 "drop table if exists pg_temp._cb_snapshot_map;"
+                 "create temp table pg_temp._cb_snapshot (id bigint, json jsonb, bin bytea, "
+                 "create_date timestamp, update_date timestamp, read_date timestamp);"
+                 "create temp table pg_temp._cb_snapshot_map (old_id bigint primary key, new_id bigint not null);",
+                 timeout=timeout)
+        with _file:
+            self.sql.copy("copy pg_temp._cb_snapshot from stdin with (format binary)",
+                          _ProgressFile(_file, progress), timeout=timeout)
+
+        _query = _set_timeout
+        _query += "insert into pg_temp._cb_snapshot_map " \
+                  "select _id, nextval('%s_id_seq') " \
+                  "from (select id as _id from pg_temp._cb_snapshot order by id) _t;" % self.table_name
+        _query += "analyze pg_temp._cb_snapshot_map;"
+        _query += self._unresolved_query
+        _unresolved = [_row[0] for _row in self.sql(_query, timeout=timeout).to_tuples()]
+        if len(_unresolved) > 0 and unresolved != "ignore":
+            _msg = "Snapshot blocks reference %d blocks which are not in snapshot: %s" % \
+                   (len(_unresolved), ", ".join([str(_id) for _id in _unresolved[:10]]))
+            if unresolved == "raise":
+                self.sql("drop table pg_temp._cb_snapshot, pg_temp._cb_snapshot_map;", timeout=timeout)
+                raise ValueError(_msg)
+            warnings.warn(_msg)
+
+        _query = _set_timeout
+        _query += self._remap_function
+        _query += "insert into %s (id, json, bin, create_date, update_date, read_date) " \
+                  "select m.new_id, pg_temp.cb_remap_ids(s.json), s.bin, " \
+                  "s.create_date, s.update_date, s.read_date " \
+                  "from pg_temp._cb_snapshot s join pg_temp._cb_snapshot_map m on s.id = m.old_id;" % \
+                  self.table_name
+        _query += "select old_id, new_id from pg_temp._cb_snapshot_map;"
+        _res = self.sql(_query, timeout=timeout).to_tuples()
+        self.sql("drop table pg_temp._cb_snapshot, pg_temp._cb_snapshot_map;", timeout=timeout)
+        return {_old: _new for _old, _new in _res}
 
 ##############################################
 # Computational block section
@@ -440,8 +1277,8 @@ class ComputationalBlock(object):
     def pull_patch_props(self, names=None, timeout=1.5):
         names = self.__class__.patch_props if names is None else names
         _pp = self.storage.pull_patch_props(names, self._last_patches, block_id=self.id, timeout=timeout)
-        _pp = _pp.to_pandas()
-        _pp = {_n: _pp[_n][0] for _n in names}
+        _pp = _pp.to_dicts()[0]
+        _pp = {_n: _pp[_n] for _n in names}
         self._set_patch_props(_pp, updates_only=True)
         self._update_last_patches(names=names)
         return self
@@ -480,10 +1317,10 @@ class ComputationalBlock(object):
     @classmethod
     def load(cls, storage, block_id, strict=True, full=True, timeout=None):
         block_id = int(block_id)
-        res = storage.load(block_id, timeout=timeout).to_pandas()
-        _json = res['json'][0]
+        res = storage.load(block_id, timeout=timeout).to_dicts()[0]
+        _json = res['json']
         _json['id'] = block_id
-        _bin = res['bin'][0].tobytes()
+        _bin = res['bin'].tobytes()
         _obj = cls.from_json_binary(storage, _json, _bin,
                                     strict=strict, full=full)
         _obj._update_last_patches()
@@ -561,6 +1398,7 @@ class ComputationalBlock(object):
         return b""
         
     def to_pandas(self):
+        import pandas as pd
         return pd.DataFrame({_k: [_v] for _k, _v in self.get_json().items()})
 
     @calculate_timer
@@ -578,9 +1416,9 @@ class CBUpdate(object):
         return
 
     def load(self, timeout=None):
-        res = self.storage.load(self.block_id, timeout=timeout).to_pandas()
-        self.json = res['json'][0]
-        self.binary = res['bin'][0]
+        res = self.storage.load(self.block_id, timeout=timeout).to_dicts()[0]
+        self.json = res['json']
+        self.binary = res['bin']
         return self
 
     def save(self, timeout=None):
@@ -603,6 +1441,7 @@ class CBUpdate(object):
             return None
 
     def to_pandas(self):
+        import pandas as pd
         return pd.DataFrame({_k: [_v] for _k, _v in self.json.items()})
 
     def _repr_html_(self):
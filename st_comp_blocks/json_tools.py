@@ -1,10 +1,12 @@
+import sys
 import json
 
-import numpy as np
-
 
 class CustomJsonEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, (np.float32, np.float64)):
+        # numpy values can appear only if numpy was imported by someone else,
+        # so we don't import it here
+        np = sys.modules.get("numpy")
+        if np is not None and isinstance(obj, (np.float32, np.float64)):
             return float(obj)
         return json.JSONEncoder.default(self, obj)